@@ -170,6 +170,7 @@ class LMCRemoteBackend(LMCBackendInterface):
             self.put_queue.put(self._EndSignal())
             self.put_thread.join()
             logger.debug("Closed the put worker")
+        self.serializer.close()
 
     def __del__(self):
         self.close()
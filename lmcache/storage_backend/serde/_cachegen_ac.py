@@ -0,0 +1,180 @@
+"""
+Triton port of the arithmetic coder in torchac / torchac_cuda.encode_fast.
+
+Each triton program encodes one (layer, token) bytestream of num_channels
+symbols, so that the output can be decoded by torchac_cuda.decode_fast.
+The coder state (low, high, pending bits) is kept in int64 registers and
+masked to 32 bits, which matches the uint32 arithmetic of torchac.
+"""
+
+import torch
+import triton
+import triton.language as tl
+from typing import Tuple
+
+@triton.jit
+def _emit_bit(out_ptr, out_len, cache, count, bit, max_out_size):
+    """ 
+    Append one bit to the byte cache, and flush the cache when it is full.
+    out_len keeps counting past max_out_size, but nothing is stored there
+    """
+    cache = (cache << 1) | bit
+    count += 1
+    full = count == 8
+    tl.store(out_ptr + out_len, cache.to(tl.uint8), mask=full & (out_len < max_out_size))
+    out_len += full.to(tl.int32)
+    cache = tl.where(full, 0, cache)
+    count = tl.where(full, 0, count)
+    return out_len, cache, count
+
+@triton.jit
+def _emit_bit_and_pending(out_ptr, out_len, cache, count, bit, pending, max_out_size):
+    """ Append one bit followed by `pending` inverted bits """
+    out_len, cache, count = _emit_bit(out_ptr, out_len, cache, count, bit, max_out_size)
+    while pending > 0:
+        out_len, cache, count = _emit_bit(out_ptr, out_len, cache, count, 1 - bit, max_out_size)
+        pending -= 1
+    return out_len, cache, count
+
+@triton.jit
+def _encode_kernel(
+        cdf_ptr,
+        sym_ptr,
+        out_ptr,
+        lengths_ptr,
+        overflow_ptr,
+        num_tokens,
+        num_channels,
+        Lp,
+        max_out_size,
+    ):
+    pid = tl.program_id(0)
+    layer = pid // num_tokens
+    sym_base = pid.to(tl.int64) * num_channels
+    cdf_base = layer.to(tl.int64) * num_channels * Lp
+    out_ptr = out_ptr + pid.to(tl.int64) * max_out_size
+
+    low = tl.full((), 0, tl.int64)
+    high = tl.full((), 0xFFFFFFFF, tl.int64)
+    pending = tl.full((), 0, tl.int64)
+    cache = tl.full((), 0, tl.int32)
+    count = tl.full((), 0, tl.int32)
+    out_len = tl.full((), 0, tl.int32)
+    max_symbol = Lp - 2
+
+    for i in range(0, num_channels):
+        sym = tl.load(sym_ptr + sym_base + i).to(tl.int64)
+        offset = cdf_base + i * Lp
+        ''' the cdf is stored as int16, but holds uint16 values '''
+        c_low = tl.load(cdf_ptr + offset + sym).to(tl.int64) & 0xFFFF
+        c_high = tl.load(cdf_ptr + offset + sym + 1).to(tl.int64) & 0xFFFF
+        c_high = tl.where(sym == max_symbol, 0x10000, c_high)
+
+        span = high - low + 1
+        high = (low - 1) + ((span * c_high) >> 16)
+        low = low + ((span * c_low) >> 16)
+
+        while (high < 0x80000000) | (low >= 0x80000000) | ((low >= 0x40000000) & (high < 0xC0000000)):
+            if high < 0x80000000:
+                out_len, cache, count = _emit_bit_and_pending(out_ptr, out_len, cache, count, 0, pending, max_out_size)
+                pending = pending * 0
+                low = (low << 1) & 0xFFFFFFFF
+                high = ((high << 1) | 1) & 0xFFFFFFFF
+            elif low >= 0x80000000:
+                out_len, cache, count = _emit_bit_and_pending(out_ptr, out_len, cache, count, 1, pending, max_out_size)
+                pending = pending * 0
+                low = (low << 1) & 0xFFFFFFFF
+                high = ((high << 1) | 1) & 0xFFFFFFFF
+            else:
+                pending += 1
+                low = (low << 1) & 0x7FFFFFFF
+                high = ((high << 1) | 0x80000001) & 0xFFFFFFFF
+
+    pending += 1
+    if low < 0x40000000:
+        out_len, cache, count = _emit_bit_and_pending(out_ptr, out_len, cache, count, 0, pending, max_out_size)
+    else:
+        out_len, cache, count = _emit_bit_and_pending(out_ptr, out_len, cache, count, 1, pending, max_out_size)
+
+    ''' flush the last byte '''
+    while count > 0:
+        out_len, cache, count = _emit_bit(out_ptr, out_len, cache, count, 0, max_out_size)
+
+    ''' report the streams that do not fit, and only keep their first max_out_size bytes '''
+    tl.store(overflow_ptr, 1, mask=out_len > max_out_size)
+    tl.store(lengths_ptr + pid, tl.minimum(out_len, max_out_size))
+
+@triton.jit
+def _compact_kernel(
+        out_ptr,
+        lengths_ptr,
+        offsets_ptr,
+        packed_ptr,
+        max_out_size,
+        BLOCK: tl.constexpr,
+    ):
+    """ Copy the valid bytes of each stream to its offset in the packed bytestream """
+    pid = tl.program_id(0)
+    length = tl.load(lengths_ptr + pid)
+    start = tl.load(offsets_ptr + pid)
+    out_ptr = out_ptr + pid.to(tl.int64) * max_out_size
+    for i in range(0, length, BLOCK):
+        idx = i + tl.arange(0, BLOCK)
+        mask = idx < length
+        data = tl.load(out_ptr + idx, mask=mask)
+        tl.store(packed_ptr + start + idx, data, mask=mask)
+
+def encode_streams(
+        cdf_int: torch.Tensor,
+        symbols: torch.Tensor,
+        max_out_size: int,
+    ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+    """
+    Arithmetic-encode every (layer, token) row of symbols into its own bytestream.
+    Nothing here synchronizes with the host
+
+    Input:
+        cdf_int: the normalized int16 cdf on GPU, in shape [nlayers, nchannels, Lp]
+        symbols: the quantized symbols on GPU, in shape [nlayers, ntokens, nchannels]
+        max_out_size: the upper bound of the length of each bytestream
+
+    Returns:
+        bytestream: uint8 tensor on GPU, the concatenated bytestreams are 
+                    stored in bytestream[:offsets[-1]]
+        offsets: int32 tensor on GPU in shape [nlayers * ntokens + 1], 
+                 offsets[i] is the start index of the i-th bytestream
+        overflow: int32 tensor on GPU in shape [1], non-zero if any bytestream
+                  exceeds max_out_size, in which case the bytestreams are invalid
+    """
+    nlayers, ntokens, nchannels = symbols.shape
+    Lp = cdf_int.shape[-1]
+    nstreams = nlayers * ntokens
+    cdf_int = cdf_int.contiguous()
+    symbols = symbols.contiguous()
+
+    out = torch.empty((nstreams, max_out_size), dtype=torch.uint8, device=symbols.device)
+    lengths = torch.empty(nstreams, dtype=torch.int32, device=symbols.device)
+    overflow = torch.zeros(1, dtype=torch.int32, device=symbols.device)
+    _encode_kernel[(nstreams,)](
+            cdf_int,
+            symbols,
+            out,
+            lengths,
+            overflow,
+            ntokens,
+            nchannels,
+            Lp,
+            max_out_size,
+            num_warps=1)
+
+    offsets = torch.zeros(nstreams + 1, dtype=torch.int32, device=symbols.device)
+    torch.cumsum(lengths, dim=0, out=offsets[1:])
+    bytestream = torch.empty(nstreams * max_out_size, dtype=torch.uint8, device=symbols.device)
+    _compact_kernel[(nstreams,)](
+            out,
+            lengths,
+            offsets,
+            bytestream,
+            max_out_size,
+            BLOCK=1024)
+    return bytestream, offsets, overflow
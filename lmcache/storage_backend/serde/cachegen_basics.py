@@ -3,7 +3,7 @@ import io
 import pickle
 from dataclasses import dataclass
 
-@dataclass
+@dataclass(frozen=True)
 class CacheGenConfig:
     # TODO: move this class to another file like "cachegen_basics.py"
     key_first_layers: int
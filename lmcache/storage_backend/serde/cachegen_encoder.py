@@ -1,11 +1,13 @@
 import io
 import pickle
-import torchac
+import functools
+import threading
 import torchac_cuda
 import numpy as np
 import torch
 from dataclasses import dataclass
-from typing import Tuple, List, Any
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Tuple, List, Any, Union
 
 from lmcache.storage_backend.serde.cachegen_basics import CacheGenConfig, CacheGenEncoderOutput
 from lmcache.storage_backend.serde.serde import Serializer
@@ -14,52 +16,75 @@ from lmcache.logging import init_logger
 
 logger = init_logger(__name__)
 
-def torch_quant(bins: int, qA: torch.Tensor) -> Tuple[torch.Tensor, float]:
+# The upper bound of the temporary memory used by the histogram in compute_cdf
+_HISTOGRAM_TILE_BYTES = 512 * 1024 * 1024
+
+try:
+    from lmcache.storage_backend.serde import _cachegen_ac
+except ImportError:
+    logger.warning("Triton is not available, CacheGen will fall back to the CPU encoder in torchac_cuda")
+    _cachegen_ac = None
+
+def torch_quant(
+        bins: Union[int, torch.Tensor], 
+        qA: torch.Tensor, 
+        zero_point: Union[int, torch.Tensor, None] = None,
+        out: torch.Tensor = None,
+    ) -> Tuple[torch.Tensor, float]:
     """
     Quantize a float tensor to fixed number of bins
 
     Input:
-        bins: number of bins
-        qA: the input tensor
+        bins: number of bins, can be a tensor broadcastable to qA (e.g., 
+              [num_layers, 1, 1]) to use different bins for different layers
+        qA: the input tensor, can be in any floating point dtype. The 
+            quantization is done in its original dtype (e.g., bf16)
+        zero_point: if given, it is added to the quantized values, which are
+                    then clamped to [0, 2 * zero_point] and returned in uint8
+        out: optional uint8 output buffer, only used with zero_point
 
     Returns:
-        xq: the quantized tensor, in float32
-        max1: the maximum value of the tensor
+        xq: the quantized tensor, in int8, or in uint8 if zero_point is given
+        max1: the maximum value of the tensor, in float32
     """
     MAX = bins // 2 - 1
     C = MAX
-    max1 = torch.amax(torch.abs(qA), dim=-1, keepdim=True)
-    xq = torch.round(qA * (C / max1)).to(torch.int8)
-    
-    x = (xq / C * max1).to(torch.float32)
-    
-    return xq, max1
-
-def concat_max(max1):
-    """
-    Given a dict of max tensors, concatenate them into a single tensor
+    max1 = torch.amax(torch.abs(qA), dim=-1, keepdim=True).float()
+    ''' divide by the max first so that the scaled values stay in [-C, C] and do not overflow in fp16 '''
+    xq = torch.round(qA / max1.to(qA.dtype) * C)
+    if zero_point is None:
+        return xq.to(torch.int8), max1
+
+    # NOTE: 0 * zero_point keeps min and max both numbers or both tensors for clamp
+    xq = torch.clamp(xq + zero_point, 0 * zero_point, 2 * zero_point)
+    if out is None:
+        return xq.to(torch.uint8), max1
+    return out.copy_(xq), max1
+
+def _compile_lazily(fn, **options):
     """
-    # TODO: this function can be optimized, we don't really need this
-    maxes = []
-    for i in range(len(max1)):
-        maxes.append(max1[i].unsqueeze(0))
-    return torch.cat(maxes, dim=0)
-
-def _renorm_cast_cdf_(cdf, precision):
-    """ The cdf normalization function in torchac
+    Wrap fn so that it is compiled with torch.compile(fn, **options) on its 
+    first call rather than at import time. If torch.compile is not supported
+    (e.g., no triton or an unsupported python version) or compiling fails, 
+    fn runs eagerly from then on
     """
-    Lp = cdf.shape[-1]
-    finals = 1  # NHW1
-    # RENORMALIZATION_FACTOR in cuda
-    f = torch.tensor(2, dtype=torch.float32, device=cdf.device).pow_(precision)
-    cdf = cdf.mul((f - (Lp - 1)) / finals)  # TODO
-    cdf = cdf.round()
-    cdf = cdf.to(dtype=torch.int16, non_blocking=True)
-    r = torch.arange(Lp, dtype=torch.int16, device=cdf.device)
-    cdf.add_(r)
-    return cdf
-
-def _split_kv(tensor: torch.Tensor) -> torch.Tensor:
+    compiled = None
+    failed = False
+
+    def wrapper(*args):
+        nonlocal compiled, failed
+        if not failed:
+            try:
+                if compiled is None:
+                    compiled = torch.compile(fn, **options)
+                return compiled(*args)
+            except Exception as e:
+                logger.warning(f"Failed to compile {fn.__name__}, falling back to eager mode: {e}")
+                failed = True
+        return fn(*args)
+    return wrapper
+
+def _split_kv(tensor: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
     """
     Split a blob KV tensor to K and V tensors with the merged heads
 
@@ -70,11 +95,31 @@ def _split_kv(tensor: torch.Tensor) -> torch.Tensor:
         K and V tensors with shape [num_layers, num_tokens, num_channels]
     """
     num_layers, _, num_tokens, num_heads, head_size = tensor.shape
-    return torch.unbind(tensor.reshape(num_layers, 2, num_tokens, num_heads * head_size), dim=1)
+    k = tensor[:, 0].reshape(num_layers, num_tokens, num_heads * head_size)
+    v = tensor[:, 1].reshape(num_layers, num_tokens, num_heads * head_size)
+    return k, v
+
+def _split_kv_hf(tensor: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Split a huggingface-format blob KV tensor to contiguous K and V tensors 
+    with the merged heads. The permute is applied after slicing K and V, so
+    that each of them is copied only once
+
+    Input:
+        tensor: the KV tensor with shape [num_layers, 2, num_heads, num_tokens, head_size]
+
+    Returns:
+        K and V tensors with shape [num_layers, num_tokens, num_channels]
+    """
+    num_layers, _, num_heads, num_tokens, head_size = tensor.shape
+    k = tensor[:, 0].permute(0, 2, 1, 3).reshape(num_layers, num_tokens, num_heads * head_size).contiguous()
+    v = tensor[:, 1].permute(0, 2, 1, 3).reshape(num_layers, num_tokens, num_heads * head_size).contiguous()
+    return k, v
 
-def _convert_to_int_and_normalize(cdf_float, needs_normalization):
+def _cdf_to_int16(cdf_float: torch.Tensor) -> torch.Tensor:
     """
-    Convert floatingpoint CDF to integers. See README for more info.
+    Convert floatingpoint CDF to normalized int16 CDF. For full chunks, it
+    is fused with the rest of _run_compiled_pipeline. See README for more info.
   
     The idea is the following:
     When we get the cdf here, it is (assumed to be) between 0 and 1, i.e,
@@ -83,27 +128,35 @@ def _convert_to_int_and_normalize(cdf_float, needs_normalization):
     We now want to convert this to int16 but make sure we do not get
     the same value twice, as this would break the arithmetic coder
     (you need a strictly monotonically increasing function).
-    So, if needs_normalization==True, we multiply the input CDF
-    with 2**16 - (Lp - 1). This means that now,
+    So, we multiply the input CDF with 2**16 - (Lp - 1). This means that now,
       cdf in [0, 2**16 - (Lp - 1)].
     Then, in a final step, we add an arange(Lp), which is just a line with
     slope one. This ensure that for sure, we will get unique, strictly
     monotonically increasing CDFs, which are in [0, 2**16)
     """
-    PRECISION = 16
     Lp = cdf_float.shape[-1]
-    factor = torch.tensor(
-      2, dtype=torch.float32, device=cdf_float.device).pow_(PRECISION)
-    new_max_value = factor
-    if needs_normalization:
-      new_max_value = new_max_value - (Lp - 1)
-    cdf_float = cdf_float.mul(new_max_value)
-    cdf_float = cdf_float.round()
-    cdf = cdf_float.to(dtype=torch.int16, non_blocking=True)
-    if needs_normalization:
-      r = torch.arange(Lp, dtype=torch.int16, device=cdf.device)
-      cdf.add_(r)
-    return cdf
+    factor = 65536.0
+    cdf = cdf_float.mul(factor - (Lp - 1)).round()
+    r = torch.arange(Lp, dtype=torch.int32, device=cdf_float.device)
+    # NOTE: the values are up to 2**16 - 1, which do not fit in int16. Float to
+    # int16 casts saturate on GPU, so cast through int32 and then wrap to int16
+    return (cdf.to(torch.int32) + r).to(torch.int16)
+
+# NOTE: the bins only depend on the model config, so they are built once 
+# rather than issuing small host to device copies on every encode. 
+# The returned tensors are shared and must not be modified in place
+@functools.lru_cache(maxsize=32)
+def _make_key_bins(config: CacheGenConfig, nlayers: int, device: torch.device) -> torch.Tensor:
+    ret = torch.full((nlayers, 1, 1), config.key_third_bins, device=device)
+    ret[:config.key_second_layers] = config.key_second_bins
+    ret[:config.key_first_layers] = config.key_first_bins
+    return ret
+
+@functools.lru_cache(maxsize=32)
+def _make_value_bins(config: CacheGenConfig, nlayers: int, device: torch.device) -> torch.Tensor:
+    ret = torch.full((nlayers, 1, 1), config.value_second_bins, device=device)
+    ret[:config.value_first_layers] = config.value_first_bins
+    return ret
 
 class CacheGenEncoderImpl:
     def __init__(self, **kwargs) -> None:
@@ -111,219 +164,273 @@ class CacheGenEncoderImpl:
         Fields: 
         - fp_kv: should be a tensor of shape (num_layers, num_tokens, num_channels)
         - fp_v: should be a tensor of shape (num_layers, num_tokens, num_channels)
+        - config: the quantization config, used to build the bins
+        - key_bins, value_bins: optional prebuilt bins in shape (num_layers, 1, 1),
+          used instead of the config if given
         """
         self.fp_k = kwargs["fp_k"]
         self.fp_v = kwargs["fp_v"]
+        self.key_bins = kwargs.get("key_bins")
+        self.value_bins = kwargs.get("value_bins")
         
-        self.quantized_key = {}
-        self.max_tensors_key = {}  
-        self.quantized_value = {}
-        self.max_tensors_value = {} 
-        self.config = kwargs["config"]
+        # quantized K and V share one uint8 buffer in shape [2 * num_layers, num_tokens, num_channels]
+        # quantized tensors in shape [num_layers, num_tokens, num_channels]
+        # max tensors in shape [num_layers, num_tokens, 1]
+        self.quantized_kv = None
+        self.quantized_key_stacked = None
+        self.max_tensors_key_stacked = None
+        self.quantized_value_stacked = None
+        self.max_tensors_value_stacked = None
+        self.config = kwargs.get("config")
         
+    def make_key_bins(self, nlayers: int) -> torch.Tensor:
+        """ Number of quantization bins of each key layer, in shape [nlayers, 1, 1] """
+        return _make_key_bins(self.config, nlayers, self.fp_k.device)
+
+    def make_value_bins(self, nlayers: int) -> torch.Tensor:
+        """ Number of quantization bins of each value layer, in shape [nlayers, 1, 1] """
+        return _make_value_bins(self.config, nlayers, self.fp_v.device)
+
     def quantize(self):
         """ Quantize the key and value tensors 
         (self.fp_k and self.fp_v) 
         """
-        for layer in range(len(self.fp_k)):
-            if layer < self.config["key_first_layers"]:
-                bins = self.config["key_first_bins"]
-            elif layer < self.config["key_second_layers"]:
-                bins = self.config["key_second_bins"]
-            else:
-                bins = self.config["key_third_bins"]
-
-            tmp = torch_quant(bins, self.fp_k[layer].float())
-            self.quantized_key[layer] = tmp[0] + bins // 2 - 1
-            self.max_tensors_key[layer] = tmp[1]
-
-        for layer in range(len(self.fp_v)):
-            if layer < self.config["value_first_layers"]:
-                bins = self.config["value_first_bins"]
-            else:
-                bins = self.config["value_second_bins"]
-            tmp = torch_quant(bins, self.fp_v[layer].float())
-            self.quantized_value[layer] = tmp[0]+ bins // 2 - 1
-            self.max_tensors_value[layer] = tmp[1]
+        nlayers = len(self.fp_k)
+        self.quantized_kv = torch.empty((2 * nlayers, *self.fp_k.shape[1:]), dtype=torch.uint8, device=self.fp_k.device)
+        self.quantized_key_stacked = self.quantized_kv[:nlayers]
+        self.quantized_value_stacked = self.quantized_kv[nlayers:]
+
+        key_bins = self.make_key_bins(nlayers) if self.key_bins is None else self.key_bins
+        _, max1 = torch_quant(key_bins, self.fp_k, key_bins // 2 - 1, out=self.quantized_key_stacked)
+        self.max_tensors_key_stacked = max1
+
+        value_bins = self.make_value_bins(nlayers) if self.value_bins is None else self.value_bins
+        _, max1 = torch_quant(value_bins, self.fp_v, value_bins // 2 - 1, out=self.quantized_value_stacked)
+        self.max_tensors_value_stacked = max1
             
-    def compute_cdf(self, is_key):
+    def compute_cdf(self, is_key, out=None):
         """
         Compute the CDF based on the quantized tensors
         Field: 
         - start_layer: the start layer to compute the CDF
         - end_layer: the end layer to compute the CDF
+        - out: optional output buffer in shape [num_layers, num_channels, 33],
+          can be a slice of a larger buffer
+
+        Returns the CDF tensor on GPU, in shape [num_layers, num_channels, 33]
         """
         # TODO: Add start_index here
-        channels = self.fp_k[0].shape[-1]
-        tokens = self.fp_k[0].shape[0]
-        
-        def process_batch(X, max_val):
-            """
-            input shape should be [channels, tokens]
-            """
-            nchannels, ntokens = X.shape
-            one_hot = torch.nn.functional.one_hot(X.long(), num_classes=max_val + 1).to(torch.float32)  # Use float32 to avoid integer overflow
-            counts = one_hot.sum(dim=1) / ntokens
-            ret = torch.cumsum(counts, dim=1).roll(1)
-            ret[:, 0] = 0
-            return ret
-
-        def process_layers(X, max_val):
+        def process_batch(X, max_val, out):
             """
-            x is a iterator of dict values
-            each element's shape is [tokens, channels]
+            input shape should be [layers, channels, tokens], in uint8
             """
-            results = []
-            for x in X:
-                ''' do permute here '''
-                batch_counts = process_batch(x.cuda().permute(1, 0), max_val)
-                results.append(batch_counts)
-
-            final_counts = torch.cat(results, dim=0)
-            
-            return final_counts
+            nlayers, nchannels, ntokens = X.shape
+            counts = torch.zeros((nlayers, nchannels, max_val + 1), dtype=torch.int32, device=X.device)
+            ''' scatter a tile of channels at a time to bound the int64 index and int32 ones temporaries '''
+            tile = max(1, _HISTOGRAM_TILE_BYTES // (nlayers * ntokens * 12))
+            for start in range(0, nchannels, tile):
+                index = X[:, start:start + tile].long()
+                counts[:, start:start + tile].scatter_add_(2, index, torch.ones_like(index, dtype=torch.int32))
+            ''' accumulate the cdf in int32, and only convert to float32 with the final divide '''
+            out[..., 1:] = torch.cumsum(counts[..., :-1], dim=-1, dtype=torch.int32) / ntokens
+            out[..., 0] = 0
+            return out
         
         if is_key:
-            X = self.quantized_key.values()
+            X = self.quantized_key_stacked
         else:
-            X = self.quantized_value.values()
+            X = self.quantized_value_stacked
         value_range = 32
-        cdfs = process_layers(X, value_range) # 4096 is batch size, ==> 18GB GPU memory
-        final_cdf = cdfs.reshape((len(self.fp_k), channels, value_range+1)).cpu()
+        ''' do permute here '''
+        X = X.cuda().permute(0, 2, 1)
+        if out is None:
+            nlayers, nchannels, _ = X.shape
+            out = torch.empty((nlayers, nchannels, value_range + 1), device=X.device)
+        final_cdf = process_batch(X, value_range, out)
                 
         return final_cdf
 
-def encode_function(kv, config, chunk_size) -> CacheGenEncoderOutput:
+def _to_host_async(tensor: torch.Tensor) -> torch.Tensor:
     """
-    Given the path to the original key value cache, encode the KV cache
+    Copy a GPU tensor to pinned host memory without blocking the host.
+    The caller must synchronize the stream before reading the result
     """
-    logger.debug(f"Jiayi: encode chunk size: {chunk_size}")
-    num_heads, head_size = kv.shape[-2:]
-    output_dict = {}
-    fp_k, fp_v = _split_kv(kv)
-    l = fp_k.shape[0]
-    encoder = CacheGenEncoderImpl(fp_k=fp_k, fp_v=fp_v, config=config)
+    host = torch.empty(tensor.shape, dtype=tensor.dtype, pin_memory=True)
+    host.copy_(tensor, non_blocking=True)
+    return host
+
+def _encode_streams_cpu(cdf_int: torch.Tensor, symbols: torch.Tensor) -> Tuple[bytes, torch.Tensor]:
+    """
+    CPU fallback of the arithmetic coder, encode each (layer, token) row 
+    of symbols into its own bytestream in one batched call of 
+    torchac_cuda.encode_many
+
+    Input:
+        cdf_int: the normalized int16 cdf, in shape [nlayers, nchannels, Lp]
+        symbols: the quantized symbols, in shape [nlayers, ntokens, nchannels]
+
+    Returns:
+        the concatenated bytestream and the int32 start index of each bytestream
+    """
+    bytestream, offsets = torchac_cuda.encode_many(cdf_int.cpu(), symbols.cpu())
+    return bytestream.numpy().tobytes(), offsets[:-1]
+
+def _quantize_and_compute_cdf(fp_k, fp_v, key_bins, value_bins):
+    """
+    The GPU part of the encoder: quantize K and V, and compute their CDFs
+
+    Input:
+        fp_k, fp_v: K and V tensors in shape [num_layers, num_tokens, num_channels]
+        key_bins, value_bins: the quantization bins in shape [num_layers, 1, 1]
+
+    Returns:
+        quantized_kv: the uint8 symbols in shape [2 * num_layers, num_tokens, num_channels]
+        max_tensors_key, max_tensors_value: the max tensors in shape [num_layers, num_tokens, 1]
+        cdf_int: the normalized int16 CDF in shape [2 * num_layers, num_channels, 33]
+    """
+    encoder = CacheGenEncoderImpl(fp_k=fp_k, fp_v=fp_v, key_bins=key_bins, value_bins=value_bins)
     encoder.quantize()
-    cdf_k = encoder.compute_cdf(is_key=True)
-    encode_input_key = torch.stack(list(encoder.quantized_key.values()))
-    
-    cdf_v = encoder.compute_cdf(is_key=False)
-    encode_input_value = torch.stack(list(encoder.quantized_value.values()))
-    cdf = torch.cat((cdf_k, cdf_v), dim=0)
-    encode_input = torch.cat((encode_input_key, encode_input_value), dim=0).cpu()
-    current_index = 0
-    start_indices = []
-    bytestreams = []
-    cdf_int = _convert_to_int_and_normalize(cdf, True)
-    for l in range(cdf.shape[0]):
-        for i in range(chunk_size):
-            bits = torchac.encode_int16_normalized_cdf(
-                    cdf_int[l:l+1],
-                    encode_input[l:l+1, i].to(torch.int16))
-            bytestreams.append(bits)
-            length = len(bits)
-            start_indices += [current_index]
-            current_index += length
-    #print(len(b"".join(bytestreams)))
-    #print(type(bytestreams[0]))
-    #print(len(start_indices))
-    #print(start_indices[:100])
-    #print(bytestreams[0])
-    #print(cdf.shape)
-    output = CacheGenEncoderOutput(
-        bytestream = b"".join(bytestreams),
-        start_indices = torch.tensor(start_indices).int(),
-        cdf = _renorm_cast_cdf_(cdf.float(), 16),
-        max_tensors_key = concat_max(encoder.max_tensors_key),
-        max_tensors_value = concat_max(encoder.max_tensors_value),
+    num_layers, _, nchannels = fp_k.shape
+    value_range = 32
+    cdf = torch.empty((2 * num_layers, nchannels, value_range + 1), device="cuda")
+    encoder.compute_cdf(is_key=True, out=cdf[:num_layers])
+    encoder.compute_cdf(is_key=False, out=cdf[num_layers:])
+    return (encoder.quantized_kv, 
+            encoder.max_tensors_key_stacked, 
+            encoder.max_tensors_value_stacked, 
+            _cdf_to_int16(cdf))
+
+# NOTE: dynamo traces the pipeline into a single graph on the first call with 
+# each input shape and dtype, and reuses it for later calls with the same ones
+_run_compiled_pipeline = _compile_lazily(_quantize_and_compute_cdf, fullgraph=True, dynamic=False)
+
+@dataclass
+class _PendingEncode:
+    """
+    An encode whose GPU work and device to host copies are still in flight.
+    The host tensors are only valid after the done event is reached
+    """
+    done: torch.cuda.Event
+    cdf: torch.Tensor
+    max_tensors_key: torch.Tensor
+    max_tensors_value: torch.Tensor
+    num_heads: int
+    head_size: int
+    # GPU bytestream, host offsets and overflow flag from triton, or host symbols for the CPU fallback
+    bytestream: torch.Tensor = None
+    offsets: torch.Tensor = None
+    overflow: torch.Tensor = None
+    symbols: torch.Tensor = None
+
+def _launch_encode(kv, config, chunk_size, requires_permute = False, compiled = False) -> _PendingEncode:
+    """
+    Issue the GPU part of encode_function on the current stream, 
+    without synchronizing with the host
+    """
+    logger.debug(f"Jiayi: encode chunk size: {chunk_size}")
+    ''' the kv may be on CPU (e.g., local_device is "cpu"), move it to GPU once '''
+    kv = kv.cuda()
+    if requires_permute:
+        num_heads, head_size = kv.shape[2], kv.shape[4]
+        fp_k, fp_v = _split_kv_hf(kv)
+    else:
+        num_heads, head_size = kv.shape[-2:]
+        fp_k, fp_v = _split_kv(kv)
+    num_layers, _, nchannels = fp_k.shape
+    ''' the bins are built outside of the compiled graph, and passed to it as tensors '''
+    key_bins = _make_key_bins(config, num_layers, fp_k.device)
+    value_bins = _make_value_bins(config, num_layers, fp_v.device)
+    if compiled:
+        encode_input, max_tensors_key, max_tensors_value, cdf_int = _run_compiled_pipeline(fp_k, fp_v, key_bins, value_bins)
+    else:
+        encode_input, max_tensors_key, max_tensors_value, cdf_int = _quantize_and_compute_cdf(fp_k, fp_v, key_bins, value_bins)
+
+    ''' issue the device to host copies early, and only wait for them before joining the bytestream '''
+    pending = _PendingEncode(
+        done = torch.cuda.Event(),
+        cdf = _to_host_async(cdf_int),
+        max_tensors_key = _to_host_async(max_tensors_key),
+        max_tensors_value = _to_host_async(max_tensors_value),
         num_heads = num_heads,
         head_size = head_size,
     )
-    return output
+    if _cachegen_ac is not None:
+        # NOTE: each symbol costs at most 16 bits with 16-bit precision cdfs
+        pending.bytestream, offsets, overflow = _cachegen_ac.encode_streams(cdf_int, encode_input, max_out_size=2 * nchannels + 16)
+        pending.offsets = _to_host_async(offsets)
+        pending.overflow = _to_host_async(overflow)
+    else:
+        pending.symbols = _to_host_async(encode_input)
+    pending.done.record()
+    return pending
 
-#TODO(Jiayi): The current implmentation does not have any performance gain
-def encode_function_gpu(kv, config, chunk_size) -> CacheGenEncoderOutput:
+def _finish_encode(pending: _PendingEncode, copy_stream = None) -> CacheGenEncoderOutput:
     """
-    Given the path to the original key value cache, encode the KV cache (with cuda)
+    Wait for a launched encode and build its output on the host. The 
+    bytestream is copied on copy_stream, or on the current stream if not given
     """
-    logger.debug(f"Jiayi: encode_cuda chunk size: {chunk_size}")
-    num_heads, head_size = kv.shape[-2:]
-    output_dict = {}
-    fp_k, fp_v = _split_kv(kv)
-    l = fp_k.shape[0]
-    encoder = CacheGenEncoderImpl(fp_k=fp_k, fp_v=fp_v, config=config)
-    encoder.quantize()
-    cdf_k = encoder.compute_cdf(is_key=True)
-    encode_input_key = torch.stack(list(encoder.quantized_key.values()))
-    
-    cdf_v = encoder.compute_cdf(is_key=False)
-    encode_input_value = torch.stack(list(encoder.quantized_value.values()))
-    cdf = torch.cat((cdf_k, cdf_v), dim=0)
-    encode_input = torch.cat((encode_input_key, encode_input_value), dim=0).cpu()
-    current_index = 0
-    start_indices = []
-    bytestreams = []
-    #cdf_int = _convert_to_int_and_normalize(cdf, True)
-    #cdf_int = cdf
-    
-    
-    cdf_temp = cdf.unsqueeze(1).repeat(1,chunk_size, 1, 1)
-    encode_input = encode_input.to(torch.int16).squeeze(0)
-    
-    
-    cdf_int = _convert_to_int_and_normalize(cdf_temp, True)
-    
-    Lp = cdf_int.shape[-1]
-    cdf_int = cdf_int.reshape(-1, Lp)
-    encode_input = encode_input.reshape(-1)
-    
-    print(f"cdf_shape: {cdf_int.shape}")
-    print(f"cdf_type: {cdf_int.dtype}")
-    print(f"cdf_device: {cdf_int.device}")
-    print(f"encode_shape: {encode_input.shape}")
-    print(f"encode_type: {encode_input.dtype}")
-    print(f"encode_device: {encode_input.device}")
-    
-    all_bits_cuda = torchac_cuda.encode_fast(cdf_int,
-                                           encode_input,
-                                           max_out_size=10000,
-                                           blockNum=64,
-                                           threadNum=chunk_size)
-    #import mytorchac_cuda
-    #all_bits_cuda = mytorchac_cuda.encode_cuda(cdf_int,
-    #                                        encode_input,
-    #                                        10000,
-    #                                        64,
-    #                                        chunk_size)
-    index = 0
-    for bits in all_bits_cuda:
-        
-        bytestreams.append(bits)
-        start_indices.append(index)
-        index += len(bits)
-    
-    print(len(b"".join(bytestreams)))
-    print(type(bytestreams[0]))
-    print(len(start_indices))
-    print(start_indices[:100])
-    print(bytestreams[0])
-    print(cdf.shape)
+    pending.done.synchronize()
+    if pending.symbols is None:
+        if pending.overflow.item() != 0:
+            raise RuntimeError("Bytestream exceeds the max_out_size!")
+        copy_stream = torch.cuda.current_stream() if copy_stream is None else copy_stream
+        copy_stream.wait_event(pending.done)
+        with torch.cuda.stream(copy_stream):
+            bytestream = _to_host_async(pending.bytestream[:int(pending.offsets[-1])])
+        copy_stream.synchronize()
+        bytestream = bytestream.numpy().tobytes()
+        start_indices = pending.offsets[:-1]
+    else:
+        bytestream, start_indices = _encode_streams_cpu(pending.cdf, pending.symbols)
+
     output = CacheGenEncoderOutput(
-        bytestream = b"".join(bytestreams),
-        start_indices = torch.tensor(start_indices).int(),
-        cdf = _renorm_cast_cdf_(cdf.float(), 16),
-        max_tensors_key = concat_max(encoder.max_tensors_key),
-        max_tensors_value = concat_max(encoder.max_tensors_value),
-        num_heads = num_heads,
-        head_size = head_size,
+        bytestream = bytestream,
+        start_indices = start_indices,
+        cdf = pending.cdf,
+        max_tensors_key = pending.max_tensors_key,
+        max_tensors_value = pending.max_tensors_value,
+        num_heads = pending.num_heads,
+        head_size = pending.head_size,
     )
     return output
 
+def encode_function(kv, config, chunk_size, requires_permute = False, compiled = False) -> CacheGenEncoderOutput:
+    """
+    Given the path to the original key value cache, encode the KV cache.
+    The arithmetic coding runs on GPU with triton, or on CPU with torchac_cuda if 
+    triton is not available
+
+    The kv is expected in shape [num_layers, 2, num_tokens, num_heads, head_size],
+    or [num_layers, 2, num_heads, num_tokens, head_size] if requires_permute is True
+    (huggingface format)
+
+    If compiled is True, the quantization and CDF computation run as a 
+    compiled graph specialized for the input shape
+    """
+    return _finish_encode(_launch_encode(kv, config, chunk_size, requires_permute, compiled))
+
 class CacheGenSerializer(Serializer):
     def __init__(self, config: LMCacheEngineConfig, metadata: LMCacheEngineMetadata):
         self.cachegen_config = CacheGenConfig.from_model_name(metadata.model_name)
         self.chunk_size = config.chunk_size
         self.fmt = metadata.fmt
+        ''' huggingface KV has the heads before the tokens, and is permuted to the canonical layout when splitting K and V '''
+        self.requires_permute = self.fmt == "huggingface"
+        # For to_bytes_async, created on its first call
+        self.encode_stream = None
+        self.copy_stream = None
+        self.finish_executor = None
+        self.inflight = None
+
+    def _launch(self, tensor: torch.Tensor) -> _PendingEncode:
+        ''' expecting a tensor of shape [num_layers, 2, num_tokens, num_heads, head_size] 
+        or [num_layers, 2, num_heads, num_tokens, head_size] for huggingface format '''
+        ntokens = tensor.shape[3] if self.requires_permute else tensor.shape[2]
+
+        # NOTE: only full chunks use the compiled graph, so that the partial
+        # chunks with arbitrary lengths do not trigger recompilations
+        compiled = ntokens == self.chunk_size
+        return _launch_encode(tensor, self.cachegen_config, ntokens, self.requires_permute, compiled)
         
     def to_bytes(
             self,
@@ -340,11 +447,56 @@ class CacheGenSerializer(Serializer):
         Returns:
             bytes: the serialized bytes
         """
-        # TODO: permute is expensive here, need a better way to do it at lower level
-        if self.fmt == "huggingface":
-            tensor = tensor.permute(0, 1, 3, 2, 4)
-
-        ''' expecting a tensor of shape [num_layers, 2, num_tokens, num_heads, head_size] '''
-        ntokens = tensor.shape[2]
-        output_dict = encode_function(tensor, self.cachegen_config, ntokens)
+        output_dict = _finish_encode(self._launch(tensor))
         return output_dict.to_bytes()
+
+    def to_bytes_async(
+            self,
+            tensor: torch.Tensor
+        ) -> Future:
+        """
+        Asynchronously serialize a pytorch tensor to bytes. The GPU work is 
+        issued on a dedicated stream and this function returns immediately,
+        so that the GPU work of the next chunk overlaps with the host side
+        work of this one
+
+        Input:
+            tensor: the input pytorch tensor, same as to_bytes
+
+        Returns:
+            Future[bytes]: resolves to the serialized bytes, in a worker thread
+        """
+        if self.finish_executor is None:
+            self.encode_stream = torch.cuda.Stream()
+            self.copy_stream = torch.cuda.Stream()
+            self.finish_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="cachegen-encode")
+            self.inflight = threading.Semaphore(2)
+
+        # NOTE: each pending encode holds its GPU bytestream, pinned buffers and
+        # the input tensor, so at most two of them (double buffering) are in 
+        # flight, and this call blocks until the older one is finished
+        self.inflight.acquire()
+        try:
+            self.encode_stream.wait_stream(torch.cuda.current_stream())
+            with torch.cuda.stream(self.encode_stream):
+                pending = self._launch(tensor)
+            ''' the caller may free the tensor before the GPU work on encode_stream is done '''
+            if tensor.is_cuda:
+                tensor.record_stream(self.encode_stream)
+        except BaseException:
+            self.inflight.release()
+            raise
+
+        def finish() -> bytes:
+            try:
+                return _finish_encode(pending, self.copy_stream).to_bytes()
+            finally:
+                self.inflight.release()
+        return self.finish_executor.submit(finish)
+
+    def close(self):
+        """ Wait for the pending to_bytes_async calls, and stop the worker thread """
+        if self.finish_executor is not None:
+            self.finish_executor.shutdown()
+            self.finish_executor = None
+            logger.debug("Closed the CacheGen encode worker")
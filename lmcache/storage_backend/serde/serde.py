@@ -22,6 +22,13 @@ class Serializer(metaclass=abc.ABCMeta):
         """
         raise NotImplementedError
 
+    def close(self):
+        """
+        Release the resources (e.g., worker threads) held by the serializer.
+        The default serializer holds none
+        """
+        pass
+
 class SerializerDebugWrapper(Serializer):
     def __init__(self, s: Serializer):
         self.s = s
@@ -34,6 +41,9 @@ class SerializerDebugWrapper(Serializer):
         logger.debug(f"Serialization took {end-start:.2f} seconds")
         return bs
 
+    def close(self):
+        self.s.close()
+
 
 class Deserializer(metaclass=abc.ABCMeta):
     @abc.abstractmethod
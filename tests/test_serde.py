@@ -1,8 +1,10 @@
 import pytest
 import torch
+import torchac
 
 from lmcache.config import LMCacheEngineConfig, LMCacheEngineMetadata
-from lmcache.storage_backend.serde.cachegen_encoder import CacheGenSerializer
+from lmcache.storage_backend.serde.cachegen_encoder import CacheGenSerializer, CacheGenEncoderImpl, torch_quant, _cdf_to_int16, _encode_streams_cpu
+from lmcache.storage_backend.serde.cachegen_basics import CacheGenConfig
 from lmcache.storage_backend.serde.cachegen_basics import CacheGenEncoderOutput
 from lmcache.storage_backend.serde.cachegen_decoder import CacheGenDeserializer
 
@@ -24,6 +26,94 @@ def generate_kv_cache(num_tokens, fmt, device):
 def to_blob(kv_tuples):
     return torch.stack([torch.stack(inner_tuple, dim=0) for inner_tuple in kv_tuples], dim=0)
 
+def torchac_encode(cdf_int, symbols):
+    ''' reference bytestreams in the torchac format, one per (layer, token) '''
+    cdf_int = cdf_int.cpu()
+    symbols = symbols.to(torch.int16).cpu()
+    all_bits = [torchac.encode_int16_normalized_cdf(cdf_int[l:l+1], symbols[l:l+1, i])
+                for l in range(symbols.shape[0]) for i in range(symbols.shape[1])]
+    lengths = torch.tensor([len(bits) for bits in all_bits], dtype = torch.int32)
+    start_indices = torch.zeros_like(lengths)
+    start_indices[1:] = torch.cumsum(lengths[:-1], dim = 0)
+    return b"".join(all_bits), start_indices
+
+def quantized_cdf_and_symbols(chunk_size):
+    config = CacheGenConfig.from_model_name("mistralai/Mistral-7B-Instruct-v0.2")
+    fp_k = torch.rand((32, chunk_size, 1024), dtype = torch.bfloat16, device = "cuda")
+    fp_v = torch.rand((32, chunk_size, 1024), dtype = torch.bfloat16, device = "cuda")
+    encoder = CacheGenEncoderImpl(fp_k = fp_k, fp_v = fp_v, config = config)
+    encoder.quantize()
+    cdf = torch.empty((64, 1024, 33), device = "cuda")
+    encoder.compute_cdf(is_key = True, out = cdf[:32])
+    encoder.compute_cdf(is_key = False, out = cdf[32:])
+    return _cdf_to_int16(cdf), encoder.quantized_kv
+
+def check_quantization_error(decoded_kv, kv, fmt):
+    ''' the coarsest layers use 16 bins, so each value is within max / 7 of the input '''
+    channel_dims = (3, 4) if fmt == "vllm" else (2, 4)
+    kv = kv.float().cpu()
+    step = kv.abs().amax(dim = channel_dims, keepdim = True) / 7
+    assert ((decoded_kv.float().cpu() - kv).abs() <= step).all()
+
+@pytest.mark.parametrize("chunk_size", [16, 128, 256])
+def test_cachegen_compute_cdf(chunk_size):
+    config = CacheGenConfig.from_model_name("mistralai/Mistral-7B-Instruct-v0.2")
+    fp_k = torch.rand((32, chunk_size, 1024), dtype = torch.bfloat16, device = "cuda")
+    fp_v = torch.rand((32, chunk_size, 1024), dtype = torch.bfloat16, device = "cuda")
+    encoder = CacheGenEncoderImpl(fp_k = fp_k, fp_v = fp_v, config = config)
+    encoder.quantize()
+
+    for is_key, quantized in [(True, encoder.quantized_key_stacked), (False, encoder.quantized_value_stacked)]:
+        cdf = encoder.compute_cdf(is_key = is_key)
+        X = quantized.cuda().permute(0, 2, 1).long()
+        counts = torch.nn.functional.one_hot(X, num_classes = 33).float().sum(dim = 2) / chunk_size
+        expected = torch.cumsum(counts, dim = -1).roll(1, dims = -1)
+        expected[..., 0] = 0
+        assert cdf.shape == (32, 1024, 33)
+        assert torch.allclose(cdf, expected)
+
+@pytest.mark.parametrize("dtype", [torch.float16, torch.bfloat16])
+def test_cachegen_quantize_small_values(dtype):
+    ''' a row max far below 1, where C / max overflows in fp16 '''
+    x = torch.linspace(-1e-4, 1e-4, 1024, dtype = dtype, device = "cuda").reshape(1, 1, 1024)
+    xq, max1 = torch_quant(16, x)
+    expected = torch.round(x.float() / max1 * 7)
+    assert (xq.float() - expected).abs().max() <= 1
+
+def test_cachegen_cdf_to_int16():
+    counts = torch.rand((64, 1024, 32))
+    cdf = torch.zeros((64, 1024, 33))
+    cdf[..., 1:] = torch.cumsum(counts / counts.sum(dim = -1, keepdim = True), dim = -1)
+
+    ''' the cpu normalization in torchac, with the int16 wrap-around made explicit '''
+    expected = cdf.mul(65536 - 32).round().to(torch.int32) + torch.arange(33, dtype = torch.int32)
+    expected = expected.to(torch.int16)
+    assert torch.equal(_cdf_to_int16(cdf.cuda()).cpu(), expected)
+
+@pytest.mark.parametrize("chunk_size", [16, 128, 256])
+def test_cachegen_gpu_arithmetic_coder(chunk_size):
+    _cachegen_ac = pytest.importorskip("lmcache.storage_backend.serde._cachegen_ac")
+    cdf_int, symbols = quantized_cdf_and_symbols(chunk_size)
+
+    bytestream, offsets, overflow = _cachegen_ac.encode_streams(cdf_int, symbols, max_out_size = 2 * 1024 + 16)
+    expected_bytestream, expected_start_indices = torchac_encode(cdf_int, symbols)
+    assert overflow.item() == 0
+    assert bytestream[:offsets[-1]].cpu().numpy().tobytes() == expected_bytestream
+    assert torch.equal(offsets[:-1].cpu(), expected_start_indices)
+
+    ''' the bytestreams do not fit in 16 bytes, which is reported rather than written out of bounds '''
+    _, _, overflow = _cachegen_ac.encode_streams(cdf_int, symbols, max_out_size = 16)
+    assert overflow.item() != 0
+
+@pytest.mark.parametrize("chunk_size", [16, 128, 256])
+def test_cachegen_cpu_arithmetic_coder(chunk_size):
+    cdf_int, symbols = quantized_cdf_and_symbols(chunk_size)
+
+    bytestream, start_indices = _encode_streams_cpu(cdf_int, symbols)
+    expected_bytestream, expected_start_indices = torchac_encode(cdf_int, symbols)
+    assert bytestream == expected_bytestream
+    assert torch.equal(start_indices, expected_start_indices)
+
 @pytest.mark.parametrize("chunk_size", [16, 128, 256])
 def test_cachegen_encoder(chunk_size):
     fmt = "vllm"
@@ -46,18 +136,37 @@ def test_cachegen_encoder(chunk_size):
 
 @pytest.mark.parametrize("fmt", ["vllm", "huggingface"])
 @pytest.mark.parametrize("chunk_size", [16, 128, 256])
-def test_cachegen_decoder(fmt, chunk_size):
+@pytest.mark.parametrize("device", ["cuda", "cpu"])
+def test_cachegen_decoder(fmt, chunk_size, device):
     config = LMCacheEngineConfig.from_defaults(chunk_size = chunk_size)
     metadata = LMCacheEngineMetadata(model_name = "mistralai/Mistral-7B-Instruct-v0.2", world_size = 1, worker_id = 0, fmt = fmt)
     serializer = CacheGenSerializer(config, metadata)
     deserializer = CacheGenDeserializer(config, metadata)
 
-    kv = to_blob(generate_kv_cache(chunk_size, fmt, "cuda"))
+    kv = to_blob(generate_kv_cache(chunk_size, fmt, device))
     output = serializer.to_bytes(kv)
 
     decoded_kv = deserializer.from_bytes(output)
     assert decoded_kv.shape == kv.shape
     assert decoded_kv.mean() != 0
+    check_quantization_error(decoded_kv, kv, fmt)
+
+@pytest.mark.parametrize("fmt", ["vllm", "huggingface"])
+def test_cachegen_encoder_async(fmt):
+    chunk_size = 256
+    config = LMCacheEngineConfig.from_defaults(chunk_size = chunk_size)
+    metadata = LMCacheEngineMetadata(model_name = "mistralai/Mistral-7B-Instruct-v0.2", world_size = 1, worker_id = 0, fmt = fmt)
+    serializer = CacheGenSerializer(config, metadata)
+
+    kvs = [to_blob(generate_kv_cache(num_tokens, fmt, "cuda")) for num_tokens in [chunk_size, chunk_size, chunk_size - 20]]
+    futures = [serializer.to_bytes_async(kv) for kv in kvs]
+    for kv, future in zip(kvs, futures):
+        output_dict = CacheGenEncoderOutput.from_bytes(future.result())
+        expected = CacheGenEncoderOutput.from_bytes(serializer.to_bytes(kv))
+        assert output_dict.bytestream == expected.bytestream
+        assert torch.equal(output_dict.start_indices, expected.start_indices)
+        assert torch.equal(output_dict.cdf, expected.cdf)
+    serializer.close()
 
 @pytest.mark.parametrize("fmt", ["vllm", "huggingface"])
 def test_cachegen_unmatched_size(fmt):
@@ -74,3 +183,4 @@ def test_cachegen_unmatched_size(fmt):
     decoded_kv = deserializer.from_bytes(output)
     assert decoded_kv.shape == kv.shape
     assert decoded_kv.mean() != 0
+    check_quantization_error(decoded_kv, kv, fmt)
@@ -11,4 +11,5 @@ namespace py = pybind11;
 PYBIND11_MODULE(torchac_cuda, m) {
     m.def("decode_fast", &decode_fast);
     m.def("encode_fast", &encode_cuda);
+    m.def("encode_many", &encode_many);
 }
\ No newline at end of file
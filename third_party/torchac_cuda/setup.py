@@ -8,7 +8,8 @@ setup(
             'torchac_cuda', 
             ['main.cpp',
             'torchac_kernel_dec.cu',
-            'torchac_kernel_enc.cu'],
+            'torchac_kernel_enc.cu',
+            'torchac_kernel_enc_cpu.cpp'],
             include_dirs=['./include']
             ),
         
@@ -37,6 +37,9 @@ std::vector<py::bytes> encode_cuda(const at::Tensor &cdf,
                                    const int blockNum, 
                                    const int threadNum);
 
+std::tuple<at::Tensor, at::Tensor> encode_many(const at::Tensor &cdf,
+                                               const at::Tensor &symbols);
+
 void decode_fast(torch::Tensor out_tensor, const at::Tensor &cdf,
                      at::Tensor concated_string, const at::Tensor start_indices, const int all_tokens, 
                      const int blockNum, const int threadNum, const int scale);
@@ -0,0 +1,174 @@
+// Batched CPU version of the arithmetic encoder.
+// The bytestreams are bit-exact with torchac.encode_int16_normalized_cdf,
+// so that they can be decoded by decode_fast.
+
+#include <torch/extension.h>
+#include <ATen/Parallel.h>
+#include <stdint.h>
+#include <tuple>
+#include <atomic>
+#include <cstring>
+
+
+/** Save output bit by bit to a fixed-size byte buffer */
+class OutCacheBuffer {
+public:
+    uint8_t* out;
+    const uint32_t max_out_size;
+    uint32_t length = 0;
+    bool overflow = false;
+    uint8_t cache = 0;
+    uint8_t count = 0;
+
+    OutCacheBuffer(uint8_t* out, const uint32_t max_out_size) : out(out), max_out_size(max_out_size) {};
+
+    inline void append(const int bit) {
+        cache <<= 1;
+        cache |= bit;
+        count += 1;
+        if (count == 8) {
+            if (length < max_out_size) {
+                out[length] = cache;
+                length += 1;
+            } else {
+                overflow = true;
+            }
+            count = 0;
+        }
+    }
+    inline void flush() {
+        while (count > 0) {
+            append(0);
+        }
+    }
+    inline void append_bit_and_pending(const int bit, uint64_t &pending_bits) {
+        append(bit);
+        while (pending_bits > 0) {
+            append(!bit);
+            pending_bits -= 1;
+        }
+    }
+};
+
+
+/** Encode one row of symbols, using one cdf row per symbol */
+static void encode_row(const uint16_t* cdf,
+                       const int32_t* sym,
+                       const int N_sym,
+                       const int Lp,
+                       OutCacheBuffer& out_cache) {
+    uint32_t low = 0;
+    uint32_t high = 0xFFFFFFFFU;
+    uint64_t pending_bits = 0;
+    const int precision = 16;
+    const int max_symbol = Lp - 2;
+
+    for (int i = 0; i < N_sym; ++i) {
+        const int sym_i = sym[i];
+        const uint64_t span = static_cast<uint64_t>(high) - static_cast<uint64_t>(low) + 1;
+        const int offset = i * Lp;
+        const uint32_t c_low = cdf[offset + sym_i];
+        const uint32_t c_high = sym_i == max_symbol ? 0x10000U : cdf[offset + sym_i + 1];
+
+        high = (low - 1) + ((span * static_cast<uint64_t>(c_high)) >> precision);
+        low =  (low)     + ((span * static_cast<uint64_t>(c_low))  >> precision);
+
+        while (true) {
+            if (high < 0x80000000U) {
+                out_cache.append_bit_and_pending(0, pending_bits);
+                low <<= 1;
+                high <<= 1;
+                high |= 1;
+            } else if (low >= 0x80000000U) {
+                out_cache.append_bit_and_pending(1, pending_bits);
+                low <<= 1;
+                high <<= 1;
+                high |= 1;
+            } else if (low >= 0x40000000U && high < 0xC0000000U) {
+                pending_bits++;
+                low <<= 1;
+                low &= 0x7FFFFFFF;
+                high <<= 1;
+                high |= 0x80000001;
+            } else {
+                break;
+            }
+        }
+    }
+
+    pending_bits += 1;
+    if (low < 0x40000000U) {
+        out_cache.append_bit_and_pending(0, pending_bits);
+    } else {
+        out_cache.append_bit_and_pending(1, pending_bits);
+    }
+    out_cache.flush();
+}
+
+
+/**
+ * Encode every (layer, token) row of symbols into its own bytestream.
+ *
+ * cdf:     int16 tensor in shape [nlayers, nchannels, Lp]
+ * symbols: integer tensor in shape [nlayers, ntokens, nchannels]
+ *
+ * Returns the concatenated uint8 bytestream, and the int32 offsets in
+ * shape [nlayers * ntokens + 1], where offsets[i] is the start index of
+ * the i-th bytestream.
+ */
+std::tuple<at::Tensor, at::Tensor> encode_many(const at::Tensor &cdf,
+                                               const at::Tensor &symbols)
+{
+    TORCH_CHECK(!cdf.is_cuda() && !symbols.is_cuda(), "cdf and symbols must be on CPU!")
+    TORCH_CHECK(cdf.dim() == 3, "Invalid size for cdf! Expected (nlayers, nchannels, Lp)")
+    TORCH_CHECK(symbols.dim() == 3, "Invalid size for symbols! Expected (nlayers, ntokens, nchannels)")
+    TORCH_CHECK(cdf.scalar_type() == at::kShort, "cdf must be int16!")
+
+    const int64_t nlayers = symbols.size(0);
+    const int64_t ntokens = symbols.size(1);
+    const int nchannels = symbols.size(2);
+    const int Lp = cdf.size(2);
+    TORCH_CHECK(cdf.size(0) == nlayers && cdf.size(1) == nchannels, "cdf and symbols do not match!")
+
+    const auto cdf_contig = cdf.contiguous();
+    const auto sym_contig = symbols.to(at::kInt).contiguous();
+    const uint16_t* cdf_data = reinterpret_cast<const uint16_t*>(cdf_contig.data_ptr<int16_t>());
+    const int32_t* sym_data = sym_contig.data_ptr<int32_t>();
+
+    // each symbol costs at most 16 bits with 16-bit precision cdfs
+    const int64_t nstreams = nlayers * ntokens;
+    const uint32_t max_out_size = 2 * nchannels + 16;
+    auto out = at::empty({nstreams, static_cast<int64_t>(max_out_size)}, at::kByte);
+    auto offsets = at::zeros({nstreams + 1}, at::kInt);
+    uint8_t* out_data = out.data_ptr<uint8_t>();
+    int32_t* offsets_data = offsets.data_ptr<int32_t>();
+    std::atomic<bool> overflow(false);
+
+    at::parallel_for(0, nstreams, 1, [&](int64_t begin, int64_t end) {
+        for (int64_t i = begin; i < end; ++i) {
+            const int64_t layer = i / ntokens;
+            OutCacheBuffer out_cache(out_data + i * max_out_size, max_out_size);
+            encode_row(cdf_data + layer * nchannels * Lp, sym_data + i * nchannels, nchannels, Lp, out_cache);
+            offsets_data[i + 1] = out_cache.length;
+            if (out_cache.overflow) {
+                overflow = true;
+            }
+        }
+    });
+    TORCH_CHECK(!overflow, "Bytestream exceeds the max_out_size!")
+
+    for (int64_t i = 0; i < nstreams; ++i) {
+        offsets_data[i + 1] += offsets_data[i];
+    }
+
+    // compact the bytestreams to their offsets
+    auto bytestream = at::empty({offsets_data[nstreams]}, at::kByte);
+    uint8_t* bytestream_data = bytestream.data_ptr<uint8_t>();
+    at::parallel_for(0, nstreams, 1, [&](int64_t begin, int64_t end) {
+        for (int64_t i = begin; i < end; ++i) {
+            std::memcpy(bytestream_data + offsets_data[i], out_data + i * max_out_size,
+                        offsets_data[i + 1] - offsets_data[i]);
+        }
+    });
+    return std::make_tuple(bytestream, offsets);
+}